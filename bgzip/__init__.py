@@ -1,7 +1,10 @@
 import io
-from math import floor, ceil
+import os
+import mmap
+import queue
+import threading
 from multiprocessing import cpu_count
-from typing import Any, Dict, Generator, IO, List, Sequence, Tuple
+from typing import Any, Dict, Generator, IO, List, Optional, Sequence, Tuple
 
 from bgzip import bgzip_utils as bgu  # type: ignore
 
@@ -11,20 +14,144 @@ from bgzip import bgzip_utils as bgu  # type: ignore
 bgzip_eof = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
 
 DEFAULT_DECOMPRESS_BUFFER_SZ = 1024 * 1024 * 50
+MAX_BLOCK_SZ = 64 * 1024  # BSIZE is a 16 bit field
+MAX_RAW_READ_CHUNK_SZ = 1024 * 1024 * 4
+
+def _alloc_buffer(size: int) -> mmap.mmap:
+    """
+    Allocate a writable buffer without zero filling it, as `bytearray` does. The buffer is a private anonymous
+    memory map: pages are only committed when first written, and are copy-on-write across `os.fork`.
+    """
+    return mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE)
+
+class _BufferPool:
+    """
+    Recycle large buffers between short lived writers. At most `max_per_size` idle buffers are kept
+    for each buffer size.
+    """
+    def __init__(self, max_per_size: int=4):
+        self.max_per_size = max_per_size
+        self._buffers: Dict[int, List[mmap.mmap]] = dict()
+        self._lock = threading.Lock()
+
+    def rent(self, size: int) -> mmap.mmap:
+        with self._lock:
+            buffers = self._buffers.get(size)
+            if buffers:
+                return buffers.pop()
+        return _alloc_buffer(size)
+
+    def return_(self, buf: mmap.mmap):
+        with self._lock:
+            buffers = self._buffers.setdefault(len(buf), list())
+            if len(buffers) < self.max_per_size:
+                buffers.append(buf)
+
+_deflate_pool = _BufferPool()
+
+def _readinto(fileobj: IO, view: memoryview) -> int:
+    if hasattr(fileobj, "readinto"):
+        return fileobj.readinto(view) or 0
+    else:
+        data = fileobj.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+class _Prefetcher:
+    """
+    Read raw chunks from `fileobj` on a background thread so I/O overlaps with inflation. Chunks are read into a
+    ring of `depth` buffers, each of which is handed back to the I/O thread once the consumer has drained it.
+    """
+    def __init__(self, fileobj: IO, chunk_size: int, depth: int=4):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._free: queue.SimpleQueue = queue.SimpleQueue()
+        self._filled: queue.SimpleQueue = queue.SimpleQueue()
+        for _ in range(depth):
+            self._free.put(memoryview(_alloc_buffer(chunk_size)))
+        self._stop = threading.Event()
+        self._current: Optional[memoryview] = None
+        self._pending = memoryview(b"")
+        self._eof = False
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                buf = self._free.get()
+                if self._stop.is_set():
+                    break
+                size = _readinto(self.fileobj, buf)
+                self._filled.put((buf, size))
+                if not size:
+                    break
+        except Exception as e:
+            self._filled.put(e)
+
+    def readinto(self, buff: memoryview) -> int:
+        # An I/O error ends the stream, so raise it on every subsequent read rather than signalling EOF
+        if self._error is not None:
+            raise self._error
+        if not self._pending and not self._eof:
+            if self._current is not None:
+                self._free.put(self._current)
+                self._current = None
+            item = self._filled.get()
+            if isinstance(item, Exception):
+                self._error = item
+                raise item
+            self._current, size = item
+            self._eof = not size
+            self._pending = self._current[:size]
+        size = min(len(buff), len(self._pending))
+        buff[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        self._stop.set()
+        # Unblock the I/O thread if it is waiting for a free buffer
+        self._free.put(None)
+        self._thread.join()
 
 class BGZipReader(io.RawIOBase):
     """
     Inflate data into a pre-allocated buffer. The buffer size will not change, and should be large enough
     to hold at least twice the data of any call to `read`.
+
+    Views returned by `read` are overwritten by later reads. To accumulate data, extend a `bytearray` with each
+    view, or use `readinto`, rather than concatenating `bytes`.
+
+    If `prefetch` is True, raw data is read from `fileobj` on a background thread, started on the first read, so
+    that slow sources such as network storage are read while data is inflated.
+
+    `fileobj` may also be an `mmap.mmap`, in which case data is inflated directly from the mapping, starting at
+    its current position, without being copied into an input buffer.
     """
     def __init__(self,
                  fileobj: IO,
                  buffer_size: int=DEFAULT_DECOMPRESS_BUFFER_SZ,
                  num_threads=cpu_count(),
-                 raw_read_chunk_size=256 * 1024):
+                 raw_read_chunk_size: Optional[int]=None,
+                 prefetch: bool=False):
+        if MAX_BLOCK_SZ > buffer_size:
+            raise ValueError(f"'buffer_size' must be at least '{MAX_BLOCK_SZ}' to hold an inflated block")
+        if raw_read_chunk_size is None:
+            raw_read_chunk_size = min(MAX_RAW_READ_CHUNK_SZ, num_threads * 256 * 1024)
+        elif 0 >= raw_read_chunk_size:
+            raise ValueError("0 < 'raw_read_chunk_size'")
         self.fileobj = fileobj
-        self._input_data = bytes()
-        self._inflate_buf = memoryview(bytearray(buffer_size))
+        self._mmap = fileobj if isinstance(fileobj, mmap.mmap) else None
+        self._advise_sequential()
+        self.prefetch = prefetch and self._mmap is None
+        self._prefetcher: Optional[_Prefetcher] = None
+        # Raw input is read into a fixed-capacity buffer. Unconsumed bytes live in `[_in_head:_in_tail]` and are
+        # moved to the front only when there is not enough room to read another chunk.
+        self._in_buf = _alloc_buffer(2 * raw_read_chunk_size + MAX_BLOCK_SZ) if self._mmap is None else bytearray()
+        self._in_head = self._in_tail = 0
+        self._inflate_buf = memoryview(_alloc_buffer(buffer_size))
         self._start = self._stop = 0
         self.raw_read_chunk_size = raw_read_chunk_size
         self.num_threads = num_threads
@@ -32,19 +159,67 @@ class BGZipReader(io.RawIOBase):
     def readable(self) -> bool:
         return True
 
+    def _advise_sequential(self):
+        # Compressed data is read front to back, so let the kernel read ahead aggressively. This is only advice:
+        # objects without a file descriptor, or closed files, are left for `read` to handle as before.
+        try:
+            if self._mmap is not None:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+            elif hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(self.fileobj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError, ValueError):
+            pass
+
+    def _fill_input(self):
+        if self._in_head == self._in_tail:
+            self._in_head = self._in_tail = 0
+        elif self._in_head and len(self._in_buf) - self._in_tail < self.raw_read_chunk_size:
+            remaining = self._in_tail - self._in_head
+            with memoryview(self._in_buf) as view:
+                view[:remaining] = view[self._in_head:self._in_tail]
+            self._in_head, self._in_tail = 0, remaining
+        with memoryview(self._in_buf)[self._in_tail:self._in_tail + self.raw_read_chunk_size] as view:
+            self._in_tail += self._readinto_raw(view)
+
+    def _readinto_raw(self, view: memoryview) -> int:
+        if self.prefetch:
+            if self._prefetcher is None:
+                self._prefetcher = _Prefetcher(self.fileobj, self.raw_read_chunk_size)
+            return self._prefetcher.readinto(view)
+        else:
+            return _readinto(self.fileobj, view)
+
+    def _input_view(self) -> memoryview:
+        if self._mmap is not None:
+            # Inflate from a window of the mapping the size of the input buffer used for other files
+            start = self._mmap.tell()
+            return memoryview(self._mmap)[start:start + 2 * self.raw_read_chunk_size + MAX_BLOCK_SZ]
+        self._fill_input()
+        return memoryview(self._in_buf)[self._in_head:self._in_tail]
+
+    def _inflate_into(self, dst: memoryview) -> Tuple[int, int]:
+        """
+        Return the number of input bytes that were available, and the number of bytes inflated into `dst`.
+        """
+        with self._input_view() as input_data:
+            bytes_read, bytes_inflated = bgu.inflate_into(input_data, dst, self.num_threads)
+            bytes_available = len(input_data)
+        if self._mmap is not None:
+            self._mmap.seek(bytes_read, os.SEEK_CUR)
+        else:
+            self._in_head += bytes_read
+        return bytes_available, bytes_inflated
+
     def _fetch_and_inflate(self):
         while True:
-            self._input_data += self.fileobj.read(self.raw_read_chunk_size)
-            inflate_info = bgu.inflate_chunks([memoryview(self._input_data)],
-                                              self._inflate_buf[self._start:],
-                                              num_threads=self.num_threads)
-            if self._input_data and not inflate_info['bytes_inflated']:
+            bytes_available, bytes_inflated = self._inflate_into(self._inflate_buf[self._start:])
+            if bytes_available and not bytes_inflated:
                 # Not enough space at end of buffer, reset indices
                 assert self._start == self._stop, "Read error. Please contact bgzip maintainers."
                 self._start = self._stop = 0
             else:
-                self._input_data = self._input_data[inflate_info['bytes_read']:]
-                self._stop += inflate_info['bytes_inflated']
+                self._stop += bytes_inflated
                 break
 
     def _read(self, requested_size: int) -> memoryview:
@@ -62,8 +237,8 @@ class BGZipReader(io.RawIOBase):
         if -1 == size:
             data = bytearray()
             while True:
+                d = self._read(1024 ** 3)
                 try:
-                    d = self._read(1024 ** 3)
                     if not d:
                         break
                     data.extend(d)
@@ -75,14 +250,21 @@ class BGZipReader(io.RawIOBase):
         return out
 
     def readinto(self, buff) -> int:
-        sz = len(buff)
-        bytes_read = 0
-        while bytes_read < sz:
-            mv = self.read(sz - bytes_read)
-            if not mv:
-                break
-            buff[bytes_read:bytes_read + len(mv)] = mv
-            bytes_read += len(mv)
+        with memoryview(buff).cast("B") as view:
+            sz = len(view)
+            bytes_read = 0
+            while bytes_read < sz:
+                if self._start == self._stop and sz - bytes_read >= MAX_BLOCK_SZ * self.num_threads:
+                    # Large reads are inflated directly into `buff`, skipping the internal buffer
+                    _, bytes_inflated = self._inflate_into(view[bytes_read:])
+                    if bytes_inflated:
+                        bytes_read += bytes_inflated
+                        continue
+                mv = self.read(sz - bytes_read)
+                if not mv:
+                    break
+                view[bytes_read:bytes_read + len(mv)] = mv
+                bytes_read += len(mv)
         return bytes_read
 
     def __iter__(self) -> Generator[bytes, None, None]:
@@ -92,15 +274,26 @@ class BGZipReader(io.RawIOBase):
             yield line
 
     def close(self):
+        if self.closed:
+            return
         super().close()
         if hasattr(self, "_buffered"):
             self._buffered.close()
+        if getattr(self, "_prefetcher", None) is not None:
+            self._prefetcher.close()
+        if hasattr(self, "_inflate_buf"):
+            self._inflate_buf.release()
 
 def inflate_chunks(chunks: Sequence[memoryview],
                    inflate_buf: memoryview,
                    num_threads: int=cpu_count(),
                    atomic: bool=False) -> Dict[str, Any]:
+    """
+    Inflate whole blocks from `chunks` into `inflate_buf`. The inflated blocks are contiguous: 'output' is a single
+    view of all inflated data, and 'blocks' holds a view of each block within it.
+    """
     inflate_info = bgu.inflate_chunks(chunks, inflate_buf, num_threads, atomic=atomic)
+    inflate_info['output'] = inflate_buf[:inflate_info['bytes_inflated']]
     blocks: List[memoryview] = [None] * len(inflate_info['block_sizes'])  # type: ignore
     total = 0
     for i, sz in enumerate(inflate_info['block_sizes']):
@@ -121,38 +314,82 @@ class BGZipWriter(io.IOBase):
 
     def _compress(self, process_all_chunks=False):
         while self._input_buffer:
-            bytes_deflated, blocks = self._deflater.deflate(self._input_buffer)
-            for b in blocks:
-                self.fileobj.write(b)
-            self._input_buffer = self._input_buffer[bytes_deflated:]
+            bytes_deflated, deflated_data, _ = self._deflater.deflate_contiguous(self._input_buffer)
+            if not bytes_deflated:
+                raise bgu.BGZIPException("Failed to deflate data.")
+            self.fileobj.write(deflated_data)
+            del self._input_buffer[:bytes_deflated]
             if len(self._input_buffer) < bgu.block_data_inflated_size and not process_all_chunks:
                 break
 
+    def _deflate_all(self, data: memoryview):
+        while data:
+            bytes_deflated, deflated_data, _ = self._deflater.deflate_contiguous(data)
+            if not bytes_deflated:
+                raise bgu.BGZIPException("Failed to deflate data.")
+            self.fileobj.write(deflated_data)
+            data = data[bytes_deflated:]
+
     def write(self, data):
-        self._input_buffer.extend(data)
-        if len(self._input_buffer) > bgu.block_batch_size * bgu.block_data_inflated_size:
-            self._compress()
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if len(data) >= bgu.block_batch_size * bgu.block_data_inflated_size:
+            # Deflate whole blocks directly from `data`, buffering only the remainder. Any buffered data is first
+            # topped up to a block boundary and deflated, which leaves block boundaries unchanged.
+            with memoryview(data).cast("B") as view:
+                if self._input_buffer:
+                    fill_size = -len(self._input_buffer) % bgu.block_data_inflated_size
+                    self._input_buffer.extend(view[:fill_size])
+                    self._compress(process_all_chunks=True)
+                    view = view[fill_size:]
+                aligned_size = len(view) - len(view) % bgu.block_data_inflated_size
+                self._deflate_all(view[:aligned_size])
+                self._input_buffer.extend(view[aligned_size:])
+        else:
+            self._input_buffer.extend(data)
+            if len(self._input_buffer) > bgu.block_batch_size * bgu.block_data_inflated_size:
+                self._compress()
 
     def close(self):
+        if self.closed:
+            return
         if self._input_buffer:
             self._compress(process_all_chunks=True)
         self.fileobj.write(bgzip_eof)
         self.fileobj.flush()
+        self._deflater.close()
+        super().close()
 
 class Deflater:
     def __init__(self, num_threads: int=cpu_count(), num_deflate_buffers: int=bgu.block_batch_size):
         self._num_threads = num_threads
-        self._deflate_bufs = self._gen_buffers(num_deflate_buffers)
+        self._deflate_buf = self._gen_buffer(num_deflate_buffers)
 
     @staticmethod
-    def _gen_buffers(number_of_buffers: int=bgu.block_batch_size) -> List[bytearray]:
-        if 0 >= number_of_buffers or bgu.block_batch_size < number_of_buffers:
-            raise ValueError(f"0 < 'number_of_buffers' <= '{bgu.block_batch_size}")
-        # Include a kilobyte of padding for poorly compressible data
-        max_deflated_block_size = bgu.block_data_inflated_size + bgu.block_metadata_size + 1024
-        return [bytearray(max_deflated_block_size) for _ in range(number_of_buffers)]
+    def _gen_buffer(number_of_blocks: int=bgu.block_batch_size) -> mmap.mmap:
+        if 0 >= number_of_blocks or bgu.block_batch_size < number_of_blocks:
+            raise ValueError(f"0 < 'number_of_blocks' <= '{bgu.block_batch_size}")
+        return _deflate_pool.rent(number_of_blocks * bgu.block_deflated_max_size)
 
-    def deflate(self, data: memoryview) -> Tuple[int, List[memoryview]]:
-        deflated_sizes = bgu.deflate_to_buffers(data, self._deflate_bufs, self._num_threads)
+    def deflate_contiguous(self, data: memoryview) -> Tuple[int, memoryview, List[int]]:
+        """
+        Deflate up to one batch of blocks from `data`. Return the number of bytes deflated, a view of the
+        deflated blocks laid out back to back, and the size of each block. The view is valid until the next call.
+        """
+        deflated_sizes = bgu.deflate_to_buffer(data, self._deflate_buf, self._num_threads)
         bytes_deflated = min(len(data), bgu.block_data_inflated_size * len(deflated_sizes))
-        return bytes_deflated, [memoryview(buf)[:sz] for buf, sz in zip(self._deflate_bufs, deflated_sizes)]
+        return bytes_deflated, memoryview(self._deflate_buf)[:sum(deflated_sizes)], deflated_sizes
+
+    def deflate(self, data: memoryview) -> Tuple[int, List[memoryview]]:
+        bytes_deflated, deflated_data, deflated_sizes = self.deflate_contiguous(data)
+        blocks: List[memoryview] = [None] * len(deflated_sizes)  # type: ignore
+        total = 0
+        for i, sz in enumerate(deflated_sizes):
+            blocks[i] = deflated_data[total: total + sz]
+            total += sz
+        return bytes_deflated, blocks
+
+    def close(self):
+        if self._deflate_buf:
+            _deflate_pool.return_(self._deflate_buf)
+            self._deflate_buf = bytearray()
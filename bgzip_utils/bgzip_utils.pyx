@@ -1,11 +1,9 @@
-import io
-import zlib
-import struct
 from math import ceil
 
-from libc.stdlib cimport abort
-from libc.string cimport memset
-from cython.parallel import prange
+from libc.stdlib cimport calloc, free
+from libc.string cimport memcmp, memmove, memset
+from libc.limits cimport UINT_MAX
+from cython.parallel import prange, threadid
 
 from czlib cimport *
 from cpython_nogil cimport *
@@ -16,9 +14,11 @@ cdef enum:
     MAGIC_LENGTH = 4
 
 block_batch_size = int(BLOCK_BATCH_SIZE)  # make BLOCK_BATCH_SIZE accessible in Python
+zlib_version = zlibVersion().decode("ascii")  # e.g. "1.3.1", or "1.3.0.zlib-ng" for zlib-ng
 
 cdef enum bgzip_err:
-    BGZIP_CRC_MISMATCH = -8
+    BGZIP_MALFORMED_EXTRA_FIELD = -9
+    BGZIP_CRC_MISMATCH
     BGZIP_ZLIB_INITIALIZATION_ERROR
     BGZIP_BLOCK_SIZE_MISMATCH
     BGZIP_BLOCK_SIZE_NEGATIVE
@@ -29,8 +29,6 @@ cdef enum bgzip_err:
     BGZIP_OK
 
 cdef const unsigned char * MAGIC = "\037\213\010\4"
-# cdef Bytef * HEADER = b"\037\213\010\4\0\0\0\0\0\377\6\0\102\103\2\0"
-cdef bytes HEADER = b"\037\213\010\4\0\0\0\0\0\377\6\0\102\103\2\0"
 
 ctypedef block_header_s BlockHeader
 cdef struct block_header_s:
@@ -66,6 +64,17 @@ cdef struct block_s:
     unsigned int available_in
     Bytef * next_out
     unsigned int avail_out
+    bgzip_err err
+
+ctypedef inflater_s Inflater
+cdef struct inflater_s:
+    z_stream zst
+    int initialized
+
+ctypedef deflater_s Deflater
+cdef struct deflater_s:
+    z_stream zst
+    int initialized
 
 ctypedef bgzip_stream_s BGZipStream
 cdef struct bgzip_stream_s:
@@ -86,27 +95,44 @@ class BGZIPException(Exception):
 class BGZIPMalformedHeaderException(BGZIPException):
     pass
 
-cdef bgzip_err inflate_block(Block * block) nogil:
-    cdef z_stream zst
+cdef check_err(bgzip_err err):
+    if BGZIP_MALFORMED_HEADER == err:
+        raise BGZIPMalformedHeaderException("Block gzip magic not found in header.")
+    elif BGZIP_MALFORMED_EXTRA_FIELD == err:
+        raise BGZIPMalformedHeaderException("Malformed extra field in block gzip header.")
+    elif BGZIP_CRC_MISMATCH == err:
+        raise BGZIPException("Inflated data does not match block CRC.")
+    elif BGZIP_BLOCK_SIZE_MISMATCH == err:
+        raise BGZIPException("Inflated data does not match block inflated size.")
+    elif BGZIP_OK != err:
+        raise BGZIPException("Failed to inflate block.")
+
+# `inflater` is initialized on first use and reset for each subsequent block, so zlib state is allocated once per
+# thread instead of once per block.
+cdef bgzip_err inflate_block(Block * block, Inflater * inflater) noexcept nogil:
+    cdef z_stream * zst = &inflater.zst
     cdef int err
 
-    zst.zalloc = NULL
-    zst.zfree = NULL
-    zst.opaque = NULL
+    if not inflater.initialized:
+        zst.zalloc = NULL
+        zst.zfree = NULL
+        zst.opaque = NULL
+        zst.avail_in = 0
+        zst.next_in = NULL
+        if Z_OK != inflateInit2(zst, -15):
+            return BGZIP_ZLIB_INITIALIZATION_ERROR
+        inflater.initialized = 1
+    elif Z_OK != inflateReset(zst):
+        return BGZIP_ZLIB_ERROR
+
     zst.avail_in = block.deflated_size
-    zst.avail_out = 1024 * 1024
+    zst.avail_out = block.inflated_size
     zst.next_in = block.next_in
     zst.next_out = block.next_out
 
-    err = inflateInit2(&zst, -15)
-    if Z_OK != err:
-        return BGZIP_ZLIB_INITIALIZATION_ERROR
-    err = inflate(&zst, Z_FINISH)
-    if Z_STREAM_END == err:
-        pass
-    else:
+    err = inflate(zst, Z_FINISH)
+    if Z_STREAM_END != err:
         return BGZIP_ZLIB_ERROR
-    inflateEnd(&zst)
 
     if block[0].inflated_size != zst.total_out:
         return BGZIP_BLOCK_SIZE_MISMATCH
@@ -119,7 +145,7 @@ cdef bgzip_err inflate_block(Block * block) nogil:
     # Difference betwwen `compress` and `deflate`:
     # https://stackoverflow.com/questions/10166122/zlib-differences-between-the-deflate-and-compress-functions
 
-cdef void * ref_and_advance(BGZipStream * rb, unsigned int member_size, bgzip_err *err) nogil:
+cdef void * ref_and_advance(BGZipStream * rb, unsigned int member_size, bgzip_err *err) noexcept nogil:
     if rb.available_in  < member_size:
         err[0] = BGZIP_INSUFFICIENT_BYTES
         return NULL
@@ -130,12 +156,12 @@ cdef void * ref_and_advance(BGZipStream * rb, unsigned int member_size, bgzip_er
         err[0] = BGZIP_OK
         return ret_val
 
-cdef bgzip_err read_block(Block * block, BGZipStream *src) nogil:
-    cdef unsigned int i
+cdef bgzip_err read_block(Block * block, BGZipStream *src) noexcept nogil:
     cdef bgzip_err err
     cdef BlockHeader * head
     cdef BlockTailer * tail
     cdef BlockHeaderSubfield * subfield
+    cdef BlockHeaderBGZipSubfield * bgzip_subfield
     cdef Bytef * subfield_data
     cdef unsigned int extra_len
 
@@ -145,30 +171,39 @@ cdef bgzip_err read_block(Block * block, BGZipStream *src) nogil:
     if err:
         return err
 
-    for i in range(<unsigned int>MAGIC_LENGTH):
-        if head.magic[i] != MAGIC[i]:
-            return BGZIP_MALFORMED_HEADER
+    if 0 != memcmp(head.magic, MAGIC, MAGIC_LENGTH):
+        return BGZIP_MALFORMED_HEADER
 
     extra_len = head.extra_len
+
+    # Fast path for the common layout, where "BC" is the only extra subfield
+    if sizeof(BlockHeaderBGZipSubfield) == extra_len and sizeof(BlockHeaderBGZipSubfield) <= src.available_in:
+        bgzip_subfield = <BlockHeaderBGZipSubfield *>src.next_in
+        if b"B" == bgzip_subfield.id_[0] and b"C" == bgzip_subfield.id_[1] and 2 == bgzip_subfield.length:
+            block.block_size = bgzip_subfield.block_size
+            ref_and_advance(src, sizeof(BlockHeaderBGZipSubfield), &err)
+            extra_len = 0
+
     while extra_len > 0:
+        if extra_len < sizeof(BlockHeaderSubfield):
+            return BGZIP_MALFORMED_EXTRA_FIELD
         subfield = <BlockHeaderSubfield *>ref_and_advance(src, sizeof(BlockHeaderSubfield), &err)
         if err:
             return err
         extra_len -= sizeof(BlockHeaderSubfield)
 
+        if extra_len < subfield.length:
+            return BGZIP_MALFORMED_EXTRA_FIELD
         subfield_data = <Bytef *>ref_and_advance(src, subfield.length, &err)
         if err:
             return err
-        extra_len -= sizeof(subfield.length)
+        extra_len -= subfield.length
 
         if b"B" == subfield.id_[0] and b"C" == subfield.id_[1]:
             if subfield.length != 2:
-                return BGZIP_MALFORMED_HEADER
+                return BGZIP_MALFORMED_EXTRA_FIELD
             block.block_size = (<unsigned short *>subfield_data)[0]
 
-    if 0 != extra_len:
-        return BGZIP_BLOCK_SIZE_MISMATCH
-
     if 0 >= block.block_size:
         return BGZIP_BLOCK_SIZE_NEGATIVE
 
@@ -186,17 +221,24 @@ cdef bgzip_err read_block(Block * block, BGZipStream *src) nogil:
     block.crc = tail.crc
     block.inflated_size = tail.inflated_size
 
-cdef py_memoryview_to_buffer(object py_memoryview, Bytef ** buf):
+cdef py_memoryview_to_buffer(object py_memoryview, Bytef ** buf, int writable=0):
     cdef PyObject * obj = <PyObject *>py_memoryview
     if PyMemoryView_Check(obj):
         # TODO: Check buffer is contiguous, has normal stride
+        if writable and (<Py_buffer *>PyMemoryView_GET_BUFFER(obj)).readonly:
+            raise TypeError("'py_memoryview' must be writable.")
         buf[0] = <Bytef *>(<Py_buffer *>PyMemoryView_GET_BUFFER(obj)).buf
         assert NULL != buf
     else:
         raise TypeError("'py_memoryview' must be a memoryview instance.")
 
-cdef void read_chunk(Chunk *chunk, int blocks_available, unsigned int output_bytes_available) nogil:
+cdef unsigned int buffer_size(object py_buf):
+    # Stream sizes are unsigned int. Clamp rather than truncate larger buffers, which are then only partly used.
+    return min(len(py_buf), UINT_MAX)
+
+cdef bgzip_err read_chunk(Chunk *chunk, int blocks_available, unsigned int output_bytes_available) noexcept nogil:
     cdef int i = 0
+    cdef bgzip_err err
     cdef BGZipStream curr
 
     for i in range(blocks_available):
@@ -209,10 +251,8 @@ cdef void read_chunk(Chunk *chunk, int blocks_available, unsigned int output_byt
         elif BGZIP_INSUFFICIENT_BYTES == err:
             chunk[0].src = curr
             break
-        elif BGZIP_MALFORMED_HEADER == err:
-            raise BGZIPMalformedHeaderException("Block gzip magic not found in header.")
         else:
-            raise BGZIPException("decompress 2 error")
+            return err
         if output_bytes_available < chunk[0].inflated_size + chunk[0].blocks[i].inflated_size:
             chunk[0].src = curr
             break
@@ -220,47 +260,97 @@ cdef void read_chunk(Chunk *chunk, int blocks_available, unsigned int output_byt
         chunk[0].inflated_size += chunk[0].blocks[i].inflated_size
         chunk[0].bytes_read += 1 + chunk[0].blocks[i].block_size
 
+    return BGZIP_OK
+
+cdef bgzip_err _inflate_chunks(Chunk * chunks,
+                               int num_src_chunks,
+                               Block * blocks,
+                               Bytef * dst_buf,
+                               unsigned int avail_out,
+                               int num_threads,
+                               int atomic,
+                               int * num_chunks_read,
+                               int * num_blocks_read) noexcept nogil:
+    cdef int i
+    cdef bgzip_err err
+    cdef Chunk atom
+    cdef Inflater * inflaters
+
+    num_chunks_read[0] = num_blocks_read[0] = 0
+    for i in range(num_src_chunks):
+        chunks[i].blocks = &blocks[num_blocks_read[0]]
+        atom = chunks[i]
+        err = read_chunk(&chunks[i], BLOCK_BATCH_SIZE - num_blocks_read[0], avail_out)
+        if BGZIP_OK != err:
+            return err
+        avail_out -= chunks[i].inflated_size
+        num_blocks_read[0] += chunks[i].num_blocks
+        if chunks[i].src.available_in:
+            if atomic:
+                num_blocks_read[0] -= chunks[i].num_blocks
+                chunks[i] = atom
+                i -= 1
+            break
+
+    num_chunks_read[0] = 1 + i if num_blocks_read[0] else 0
+
+    for i in range(num_blocks_read[0]):
+        blocks[i].next_out = dst_buf
+        dst_buf += blocks[i].inflated_size
+
+    if not num_blocks_read[0]:
+        return BGZIP_OK
+
+    # Don't start more threads than there are blocks to inflate
+    num_threads = min(num_threads, num_blocks_read[0])
+    inflaters = <Inflater *>calloc(num_threads, sizeof(Inflater))
+    if NULL == inflaters:
+        return BGZIP_ERROR
+
+    for i in prange(num_blocks_read[0], num_threads=num_threads, schedule="dynamic"):
+        blocks[i].err = inflate_block(&blocks[i], &inflaters[threadid()])
+
+    for i in range(num_threads):
+        if inflaters[i].initialized:
+            inflateEnd(&inflaters[i].zst)
+    free(inflaters)
+
+    for i in range(num_blocks_read[0]):
+        if BGZIP_OK != blocks[i].err:
+            return blocks[i].err
+
+    return BGZIP_OK
+
 def inflate_chunks(list py_chunks, object py_dst_buf, int num_threads, atomic: bool=False):
     """
     Inflate bytes from `py_chunks` into `dst_buff`
     """
-    cdef int i, err, num_chunks_read, num_src_chunks = 0, num_blocks_read = 0, _atomic = int(atomic)
+    cdef int i, num_chunks_read, num_src_chunks = 0, num_blocks_read = 0, _atomic = int(atomic)
+    cdef bgzip_err err
+    cdef unsigned int bytes_read = 0, bytes_inflated = 0
     cdef Bytef * dst_buf = NULL
     cdef Block blocks[BLOCK_BATCH_SIZE]
-    cdef Chunk atom, chunks[BLOCK_BATCH_SIZE]
+    cdef Chunk chunks[BLOCK_BATCH_SIZE]
 
     memset(&chunks[0], 0, BLOCK_BATCH_SIZE * sizeof(Chunk))
 
     num_src_chunks = min(len(py_chunks), BLOCK_BATCH_SIZE)
     for i in range(num_src_chunks):
         py_memoryview_to_buffer(py_chunks[i], &chunks[i].src.next_in)
-        chunks[i].src.available_in = len(py_chunks[i])
+        chunks[i].src.available_in = buffer_size(py_chunks[i])
 
-    py_memoryview_to_buffer(py_dst_buf, &dst_buf)
-    cdef unsigned int avail_out = PySequence_Size(<PyObject *>py_dst_buf)
+    py_memoryview_to_buffer(py_dst_buf, &dst_buf, writable=1)
+    cdef unsigned int avail_out = buffer_size(py_dst_buf)
 
     with nogil:
-        for i in range(num_src_chunks):
-            chunks[i].blocks = &blocks[num_blocks_read]
-            atom = chunks[i]
-            read_chunk(&chunks[i], BLOCK_BATCH_SIZE - num_blocks_read, avail_out)
-            avail_out -= chunks[i].inflated_size
-            num_blocks_read += chunks[i].num_blocks
-            if chunks[i].src.available_in:
-                if _atomic:
-                    num_blocks_read -= chunks[i].num_blocks
-                    chunks[i] = atom
-                    i -= 1
-                break
-
-        num_chunks_read = 1 + i if num_blocks_read else 0
-
-        for i in range(num_blocks_read):
-            blocks[i].next_out = dst_buf
-            dst_buf += blocks[i].inflated_size
-
-        for i in prange(num_blocks_read, num_threads=num_threads, schedule="dynamic"):
-            inflate_block(&blocks[i])
+        err = _inflate_chunks(chunks, num_src_chunks, blocks, dst_buf, avail_out, num_threads, _atomic,
+                              &num_chunks_read, &num_blocks_read)
+
+        for i in range(num_chunks_read):
+            bytes_read += chunks[i].bytes_read
+            bytes_inflated += chunks[i].inflated_size
+
+    check_err(err)
 
     remaining_chunks = list()
     for i, py_chunk in enumerate(py_chunks):
@@ -270,14 +360,43 @@ def inflate_chunks(list py_chunks, object py_dst_buf, int num_threads, atomic: b
         else:
             remaining_chunks.append(py_chunk)
 
-    return {'bytes_read':       sum(chunks[i].bytes_read for i in range(num_chunks_read)),
-            'bytes_inflated':   sum(chunks[i].inflated_size for i in range(num_chunks_read)),
+    return {'bytes_read':       bytes_read,
+            'bytes_inflated':   bytes_inflated,
             'remaining_chunks': remaining_chunks,
             'block_sizes':      [blocks[i].inflated_size for i in range(num_blocks_read)],
             'blocks_per_chunk': [chunks[i].num_blocks for i in range(num_chunks_read)]}
 
-cdef bgzip_err compress_block(Block * block) nogil:
-    cdef z_stream zst
+def inflate_into(object py_src_buf, object py_dst_buf, int num_threads):
+    """
+    Inflate as many whole blocks from `py_src_buf` into `py_dst_buf` as will fit. This is `inflate_chunks` for a
+    single chunk, without allocating Python objects for each block.
+
+    Return a tuple `(bytes_read, bytes_inflated)`.
+    """
+    cdef int num_chunks_read, num_blocks_read
+    cdef bgzip_err err
+    cdef Bytef * dst_buf = NULL
+    cdef Block blocks[BLOCK_BATCH_SIZE]
+    cdef Chunk chunk
+
+    memset(&chunk, 0, sizeof(Chunk))
+    py_memoryview_to_buffer(py_src_buf, &chunk.src.next_in)
+    chunk.src.available_in = buffer_size(py_src_buf)
+
+    py_memoryview_to_buffer(py_dst_buf, &dst_buf, writable=1)
+    cdef unsigned int avail_out = buffer_size(py_dst_buf)
+
+    with nogil:
+        err = _inflate_chunks(&chunk, 1, blocks, dst_buf, avail_out, num_threads, 0,
+                              &num_chunks_read, &num_blocks_read)
+
+    check_err(err)
+
+    return chunk.bytes_read, chunk.inflated_size
+
+# As with `inflate_block`, `deflater` is initialized on first use and reset for each subsequent block.
+cdef bgzip_err compress_block(Block * block, Deflater * deflater) noexcept nogil:
+    cdef z_stream * zst = &deflater.zst
     cdef int err = 0
     cdef BlockHeader * head
     cdef BlockHeaderBGZipSubfield * head_subfield
@@ -291,20 +410,23 @@ cdef bgzip_err compress_block(Block * block) nogil:
     head_subfield = <BlockHeaderBGZipSubfield *>block.next_out
     block.next_out += sizeof(BlockHeaderBGZipSubfield)
 
-    zst.zalloc = NULL
-    zst.zfree = NULL
-    zst.opaque = NULL
+    if not deflater.initialized:
+        zst.zalloc = NULL
+        zst.zfree = NULL
+        zst.opaque = NULL
+        if Z_OK != deflateInit2(zst, Z_BEST_COMPRESSION, Z_DEFLATED, wbits, mem_level, Z_DEFAULT_STRATEGY):
+            return BGZIP_ZLIB_INITIALIZATION_ERROR
+        deflater.initialized = 1
+    elif Z_OK != deflateReset(zst):
+        return BGZIP_ZLIB_ERROR
+
     zst.next_in = block.next_in
     zst.avail_in = block.available_in
     zst.next_out = block.next_out
-    zst.avail_out = 1024 * 1024
-    err = deflateInit2(&zst, Z_BEST_COMPRESSION, Z_DEFLATED, wbits, mem_level, Z_DEFAULT_STRATEGY)
-    if Z_OK != err:
-        return BGZIP_ZLIB_ERROR
-    err = deflate(&zst, Z_FINISH)
+    zst.avail_out = block.avail_out - sizeof(BlockHeader) - sizeof(BlockHeaderBGZipSubfield) - sizeof(BlockTailer)
+    err = deflate(zst, Z_FINISH)
     if Z_STREAM_END != err:
         return BGZIP_ZLIB_ERROR
-    deflateEnd(&zst)
 
     block.next_out += zst.total_out
 
@@ -331,38 +453,52 @@ cdef bgzip_err compress_block(Block * block) nogil:
 
 cdef unsigned int _block_data_inflated_size = 65280
 cdef unsigned int _block_metadata_size = sizeof(BlockHeader) + sizeof(BlockHeaderBGZipSubfield) + sizeof(BlockTailer)
+# Include a kilobyte of padding for poorly compressible data
+cdef unsigned int _block_deflated_max_size = _block_data_inflated_size + _block_metadata_size + 1024
 block_data_inflated_size = _block_data_inflated_size
 block_metadata_size = _block_metadata_size
+block_deflated_max_size = _block_deflated_max_size
 
-cdef void _get_buffer(PyObject * obj, Py_buffer * view):
+cdef void _get_buffer(PyObject * obj, Py_buffer * view, int flags=PyBUF_SIMPLE):
     cdef int err
 
-    err = PyObject_GetBuffer(obj, view, PyBUF_SIMPLE)
+    err = PyObject_GetBuffer(obj, view, flags)
     if -1 == err:
         raise Exception()
 
-def deflate_to_buffers(py_input_buff, list py_deflated_buffers, int num_threads):
+def deflate_to_buffer(py_input_buff, py_deflated_buff, int num_threads):
     """
-    Compress the data in `py_input_buff` and write it to `handle`.
+    Compress the data in `py_input_buff` into consecutive blocks written to `py_deflated_buff`.
+
+    Each block is compressed into its own `block_deflated_max_size` slot of `py_deflated_buff`, then the blocks
+    are moved together, so the deflated data is contiguous at the start of `py_deflated_buff`. The number of
+    blocks compressed is limited by the number of slots available.
 
-    `deflated_buffers` should contain enough buffers to hold the number of blocks compressed. Each
-    buffer should hold `_block_data_inflated_size + _block_metadata_size` bytes.
+    Return the size of each deflated block.
     """
-    cdef int i, chunk_size
+    cdef int i, chunk_size, number_of_chunks
     cdef unsigned int bytes_available = len(py_input_buff)
-    cdef int number_of_chunks = min(ceil(bytes_available / block_data_inflated_size),
-                                    len(py_deflated_buffers))
     cdef Block blocks[BLOCK_BATCH_SIZE]
-    cdef PyObject * deflated_buffers = <PyObject *>py_deflated_buffers
-    cdef PyObject * compressed_chunk
+    cdef Bytef * deflated_slot
+    cdef Bytef * deflated_end
+    cdef bgzip_err err = BGZIP_OK
+    cdef Py_buffer input_view, deflated_view
+    cdef Deflater * deflaters
+
+    number_of_chunks = min(ceil(bytes_available / block_data_inflated_size),
+                           len(py_deflated_buff) // block_deflated_max_size,
+                           BLOCK_BATCH_SIZE)
+    num_threads = max(1, min(num_threads, number_of_chunks))
 
-    cdef Py_buffer input_view 
     _get_buffer(<PyObject *>py_input_buff, &input_view)
+    try:
+        _get_buffer(<PyObject *>py_deflated_buff, &deflated_view, PyBUF_WRITABLE)
+    except Exception:
+        PyBuffer_Release(&input_view)
+        raise
 
     with nogil:
         for i in range(number_of_chunks):
-            compressed_chunk = <PyObject *>PyList_GetItem(deflated_buffers, i)
-
             if bytes_available >= _block_data_inflated_size:
                 chunk_size = _block_data_inflated_size
             else:
@@ -373,14 +509,35 @@ def deflate_to_buffers(py_input_buff, list py_deflated_buffers, int num_threads)
             blocks[i].inflated_size = chunk_size
             blocks[i].next_in = <Bytef *>input_view.buf + (i * _block_data_inflated_size)
             blocks[i].available_in = chunk_size
-            blocks[i].next_out = <Bytef *>PyByteArray_AS_STRING(compressed_chunk)
-            blocks[i].avail_out = _block_data_inflated_size + _block_metadata_size
+            blocks[i].next_out = <Bytef *>deflated_view.buf + (i * _block_deflated_max_size)
+            blocks[i].avail_out = _block_deflated_max_size
 
-        for i in prange(number_of_chunks, num_threads=num_threads, schedule="dynamic"):
-            if BGZIP_OK != compress_block(&blocks[i]):
-                with gil:
-                    raise BGZIPException()
+        deflaters = <Deflater *>calloc(num_threads, sizeof(Deflater))
+        if NULL == deflaters:
+            err = BGZIP_ERROR
+        else:
+            for i in prange(number_of_chunks, num_threads=num_threads, schedule="dynamic"):
+                blocks[i].err = compress_block(&blocks[i], &deflaters[threadid()])
+
+            for i in range(num_threads):
+                if deflaters[i].initialized:
+                    deflateEnd(&deflaters[i].zst)
+            free(deflaters)
+
+            deflated_end = <Bytef *>deflated_view.buf
+            for i in range(number_of_chunks):
+                if BGZIP_OK != blocks[i].err:
+                    err = blocks[i].err
+                    break
+                deflated_slot = <Bytef *>deflated_view.buf + (i * _block_deflated_max_size)
+                if deflated_end != deflated_slot:
+                    memmove(deflated_end, deflated_slot, blocks[i].block_size)
+                deflated_end += blocks[i].block_size
 
     PyBuffer_Release(&input_view)
+    PyBuffer_Release(&deflated_view)
+
+    if BGZIP_OK != err:
+        raise BGZIPException("Failed to deflate block.")
 
     return [blocks[i].block_size for i in range(number_of_chunks)]
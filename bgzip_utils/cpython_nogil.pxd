@@ -22,6 +22,7 @@ cdef extern from "Python.h":
     extern int PyObject_GetBuffer(PyObject *, Py_buffer *, int flags)
     extern void PyBuffer_Release(Py_buffer *)
     extern int PyBUF_SIMPLE
+    extern int PyBUF_WRITABLE
 
     extern void Py_INCREF(PyObject *) nogil
     extern void Py_DECREF(PyObject *) nogil
@@ -16,14 +16,18 @@ cdef extern from "zlib.h":
 
     extern int inflate(z_stream * strm, int flush) nogil
     extern int inflateInit2(z_stream * strm, int wbits) nogil
+    extern int inflateReset(z_stream * strm) nogil
     extern int inflateEnd(z_stream *) nogil
 
     extern int deflate(z_stream * strm, int flush) nogil
     extern int deflateInit2(z_stream * strm, int level, int method, int wbits, int  mem_level, int strategy) nogil
+    extern int deflateReset(z_stream * strm) nogil
     extern int deflateEnd(z_stream *) nogil
 
     extern uLongf crc32(uLongf crc, const Bytef * data, unsigned int len) nogil
 
+    extern const char * zlibVersion()
+
     extern int Z_OK
     extern int Z_FINISH
     extern int Z_STREAM_END
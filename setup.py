@@ -23,12 +23,21 @@ else:
     extra_compile_args = ["-O3", "-fopenmp"]
     extra_link_args = ["-fopenmp"]
 
+# Link against any library providing the zlib API, e.g. a zlib-ng compat build (also named "z") installed outside the
+# system paths, with its headers in BGZIP_ZLIB_INCLUDE_DIR and its library in BGZIP_ZLIB_LIBRARY_DIR.
+zlib_library = os.environ.get("BGZIP_ZLIB_LIBRARY", "z")
+zlib_include_dirs = [os.environ["BGZIP_ZLIB_INCLUDE_DIR"]] if os.environ.get("BGZIP_ZLIB_INCLUDE_DIR") else []
+zlib_library_dirs = [os.environ["BGZIP_ZLIB_LIBRARY_DIR"]] if os.environ.get("BGZIP_ZLIB_LIBRARY_DIR") else []
+
 file_ext = "pyx" if os.environ.get("BUILD_WITH_CYTHON") else "c"
 extensions = [
     Extension(
         name="bgzip.bgzip_utils",
         sources=[f"bgzip_utils/bgzip_utils.{file_ext}"],
-        libraries=["z"],
+        libraries=[zlib_library],
+        include_dirs=zlib_include_dirs,
+        library_dirs=zlib_library_dirs,
+        runtime_library_dirs=zlib_library_dirs,
         extra_compile_args=extra_compile_args,
         extra_link_args=extra_link_args,
     )
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 import io
 import os
+import array
 import sys
 import gzip
+import mmap
 import random
+import struct
 import unittest
+import multiprocessing
 from random import randint
+from unittest import mock
 from typing import Any, Generator, List, Sequence
 
 pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))  # noqa
@@ -18,11 +23,11 @@ class TestBGZipReader(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
-            with gzip.GzipFile(fileobj=raw) as fh:
-                cls.expected_data = fh.read()
+            cls.fixture_bytes = raw.read()
+        cls.expected_data = gzip.decompress(cls.fixture_bytes)
 
     def test_read(self):
-        with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+        with io.BytesIO(self.fixture_bytes) as raw:
             with bgzip.BGZipReader(raw, 1024 * 1024 * 1) as fh:
                 data = bytearray()
                 while True:
@@ -33,19 +38,145 @@ class TestBGZipReader(unittest.TestCase):
                     d.release()
         self.assertEqual(self.expected_data, data)
 
+    def test_read_prefetch(self):
+        with self.subTest("read all"):
+            with io.BytesIO(self.fixture_bytes) as raw:
+                with bgzip.BGZipReader(raw, 1024 * 1024 * 1, raw_read_chunk_size=10 * 1024, prefetch=True) as fh:
+                    data = bytearray()
+                    while True:
+                        d = fh.read(randint(1024 * 1, 1024 * 1024))
+                        if not d:
+                            break
+                        data.extend(d)
+                        d.release()
+            self.assertEqual(self.expected_data, data)
+
+        with self.subTest("close before reading everything"):
+            with io.BytesIO(self.fixture_bytes) as raw:
+                with bgzip.BGZipReader(raw, raw_read_chunk_size=1024, prefetch=True) as fh:
+                    fh.read(1024)
+                self.assertFalse(fh._prefetcher._thread.is_alive())
+
+        with self.subTest("read error is raised on every read"):
+            class Raw:
+                def readinto(self, buff):
+                    raise OSError("read failed")
+
+            with bgzip.BGZipReader(Raw(), prefetch=True) as fh:  # type: ignore
+                for _ in range(2):
+                    with self.assertRaises(OSError):
+                        fh.read(1024)
+
+    def test_read_mmap(self):
+        with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+            with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with bgzip.BGZipReader(mm, 1024 * 1024 * 1) as fh:  # type: ignore
+                    data = bytearray()
+                    while True:
+                        d = fh.read(randint(1024 * 1, 1024 * 1024))
+                        if not d:
+                            break
+                        data.extend(d)
+                        d.release()
+        self.assertEqual(self.expected_data, data)
+
+    def test_read_large_mmap(self):
+        # Mappings past 4 GiB must not have their length truncated. Untouched pages of the mapping are not committed.
+        expected_data = os.urandom(1024)
+        _, blocks = bgzip.Deflater().deflate(memoryview(expected_data))
+        first_block = bytes(blocks[0])
+        with mmap.mmap(-1, 2 ** 32 + 100, flags=mmap.MAP_PRIVATE) as mm:
+            # Follow the first block with the header and tailer of a 64 KiB block, which neither the reader's
+            # input window nor the 1024 byte inflate buffer below can hold
+            mm.write(first_block)
+            mm.write(first_block[:16] + struct.pack("<H", 2 ** 16 - 1))
+            mm[len(first_block) + 2 ** 16 - 4:len(first_block) + 2 ** 16] = struct.pack("<I", 2 ** 16)
+            mm.seek(0)
+            with bgzip.BGZipReader(mm, 1024 * 1024 * 1, raw_read_chunk_size=1) as fh:  # type: ignore
+                self.assertEqual(expected_data, fh.read(1024))
+            with memoryview(mm) as src:
+                inflate_buf = memoryview(bytearray(1024))
+                self.assertEqual((len(first_block), 1024), bgzip.bgu.inflate_into(src, inflate_buf, 4))
+
+    @unittest.skipUnless(hasattr(os, "posix_fadvise") and hasattr(mmap, "MADV_SEQUENTIAL"), "requires fadvise")
+    def test_advise_sequential(self):
+        with self.subTest("file"):
+            with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+                with mock.patch("os.posix_fadvise") as posix_fadvise:
+                    bgzip.BGZipReader(raw).close()
+                posix_fadvise.assert_called_once_with(raw.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        with self.subTest("mmap"):
+            class MMap(mmap.mmap):
+                pass
+
+            with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+                with MMap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    with mock.patch.object(MMap, "madvise") as madvise:
+                        bgzip.BGZipReader(mm).close()  # type: ignore
+                    madvise.assert_called_once_with(mmap.MADV_SEQUENTIAL)
+
+        with self.subTest("no file descriptor"):
+            with mock.patch("os.posix_fadvise") as posix_fadvise:
+                bgzip.BGZipReader(io.BytesIO(self.fixture_bytes)).close()
+            posix_fadvise.assert_not_called()
+
+        with self.subTest("closed file"):
+            with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+                pass
+            with bgzip.BGZipReader(raw) as fh:
+                with self.assertRaises(ValueError):
+                    fh.read(1024)
+
+    def test_read_without_readinto(self):
+        class Raw:
+            def __init__(self, fileobj):
+                self.fileobj = fileobj
+
+            def read(self, size):
+                return self.fileobj.read(size)
+
+        with io.BytesIO(self.fixture_bytes) as raw:
+            with bgzip.BGZipReader(Raw(raw)) as fh:  # type: ignore
+                data = fh.read()
+        self.assertEqual(self.expected_data, data)
+
+    def test_buffer_sizes(self):
+        for kwargs in [dict(buffer_size=bgzip.MAX_BLOCK_SZ - 1), dict(raw_read_chunk_size=0)]:
+            with self.subTest(**kwargs):
+                with self.assertRaises(ValueError):
+                    bgzip.BGZipReader(io.BytesIO(), **kwargs)  # type: ignore
+
+        with self.subTest("smallest buffers"):
+            with io.BytesIO(self.fixture_bytes) as raw:
+                with bgzip.BGZipReader(raw, bgzip.MAX_BLOCK_SZ, raw_read_chunk_size=1024) as fh:
+                    data = fh.read()
+            self.assertEqual(self.expected_data, data)
+
     def test_empty(self):
         with bgzip.BGZipReader(io.BytesIO()) as fh:
             d = fh.read(1024)
             self.assertEqual(0, len(d))
 
     def test_read_all(self):
-        with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+        with io.BytesIO(self.fixture_bytes) as raw:
             with bgzip.BGZipReader(raw) as fh:
                 data = fh.read()
         self.assertEqual(data, self.expected_data)
 
+    def test_view_outlives_reader(self):
+        with bgzip.BGZipReader(io.BytesIO(self.fixture_bytes)) as fh:
+            head = fh.read(20)
+        other = io.BytesIO()
+        with bgzip.BGZipWriter(other) as writer:
+            writer.write(os.urandom(1024))
+        other.seek(0)
+        with bgzip.BGZipReader(other) as fh:
+            fh.read()
+        self.assertEqual(self.expected_data[:20], head)
+
     def test_read_into(self):
-        with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+        with io.BytesIO(self.fixture_bytes) as raw:
             data = bytearray()
             with bgzip.BGZipReader(raw) as fh:
                 while True:
@@ -56,23 +187,53 @@ class TestBGZipReader(unittest.TestCase):
                     d.release()
         self.assertEqual(self.expected_data, data)
 
+    def test_readinto(self):
+        for buff_size in [1024, 1024 * 1024 * 10]:
+            with self.subTest(buff_size=buff_size):
+                with io.BytesIO(self.fixture_bytes) as raw:
+                    data = bytearray()
+                    buff = bytearray(buff_size)
+                    with bgzip.BGZipReader(raw, 1024 * 1024 * 1) as fh:
+                        while True:
+                            sz = fh.readinto(buff)
+                            if not sz:
+                                break
+                            data.extend(buff[:sz])
+                self.assertEqual(self.expected_data, data)
+
+        with self.subTest("typed buffer"):
+            with io.BytesIO(self.fixture_bytes) as raw:
+                buff = array.array("I", bytes(1024 * 1024))
+                with bgzip.BGZipReader(raw, 1024 * 1024 * 1) as fh:
+                    sz = fh.readinto(buff)
+            self.assertEqual(len(buff) * buff.itemsize, sz)
+            self.assertEqual(self.expected_data[:sz], buff.tobytes())
+
+        for buff_size in [1024, 1024 * 1024 * 8]:
+            with self.subTest("read-only buffer", buff_size=buff_size):
+                buff = bytes(buff_size)
+                with bgzip.BGZipReader(io.BytesIO(self.fixture_bytes), num_threads=4) as fh:
+                    with self.assertRaises(TypeError):
+                        fh.readinto(buff)
+                self.assertEqual(bytes(buff_size), buff)
+
     def test_iter(self):
         with self.subTest("iter byte lines"):
-            data = b""
-            with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+            data = bytearray()
+            with io.BytesIO(self.fixture_bytes) as raw:
                 with bgzip.BGZipReader(raw, 1024 * 1024 * 1) as fh:
                     for line in fh:
                         data += line
             self.assertEqual(self.expected_data, data)
 
         with self.subTest("iter text lines"):
-            content = ""
-            with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+            lines = list()
+            with io.BytesIO(self.fixture_bytes) as raw:
                 with bgzip.BGZipReader(raw, 1024 * 1024 * 1) as fh:
                     with io.TextIOWrapper(fh, "utf-8") as handle:
                         for line in handle:
-                            content += line
-            self.assertEqual(self.expected_data.decode("utf-8"), content)
+                            lines.append(line)
+            self.assertEqual(self.expected_data.decode("utf-8"), "".join(lines))
 
     def test_inflate_chunks(self):
         size = (2 * bgzip.bgu.block_batch_size + 1) * bgzip.bgu.block_data_inflated_size
@@ -80,25 +241,32 @@ class TestBGZipReader(unittest.TestCase):
         inflate_buf = memoryview(bytearray(30 * 1024 * 1024))
 
         data = memoryview(expected_data)
-        deflated_blocks = list()
+        deflated_data, block_sizes = bytearray(), list()
         deflater = bgzip.Deflater()
         while data:
-            bytes_deflated, blocks = deflater.deflate(data)
-            deflated_blocks.extend([bytes(b) for b in blocks])
+            bytes_deflated, deflated, sizes = deflater.deflate_contiguous(data)
+            deflated_data.extend(deflated)
+            block_sizes.extend(sizes)
             data = data[bytes_deflated:]
+        deflated_view = memoryview(bytes(deflated_data))
+        deflated_blocks = list()
+        offset = 0
+        for sz in block_sizes:
+            deflated_blocks.append(deflated_view[offset:offset + sz])
+            offset += sz
 
         def _test_inflate_chunks(remaining_chunks: List[memoryview], atomic: bool=False):
             remaining_chunks = remaining_chunks.copy()
-            reinflated_data = b""
+            reinflated_data = bytearray()
             while remaining_chunks:
                 inflate_info = bgzip.inflate_chunks(remaining_chunks, inflate_buf, atomic=atomic)
                 self.assertGreater(inflate_info['bytes_inflated'], 0)
                 remaining_chunks = inflate_info['remaining_chunks']
-                reinflated_data += b"".join(inflate_info['blocks'])
+                reinflated_data.extend(inflate_info['output'])
             self.assertEqual(expected_data, reinflated_data)
 
         with self.subTest("all blocks"):
-            _test_inflate_chunks([memoryview(bytes(b)) for b in deflated_blocks])
+            _test_inflate_chunks(deflated_blocks)
 
         with self.subTest("chunked blocks"):
             _test_inflate_chunks([memoryview(b"".join(chunk))
@@ -139,27 +307,116 @@ class TestBGZipReader(unittest.TestCase):
             self.assertEqual(list(), inflate_info['block_sizes'])
             self.assertEqual(list(), inflate_info['blocks_per_chunk'])
             self.assertEqual(list(), inflate_info['blocks'])
+            self.assertEqual(0, len(inflate_info['output']))
 
         with self.subTest("passing in non-memoryview buffers should raise"):
             with self.assertRaises(TypeError):
                 bgzip.inflate_chunks([b"asfd"], inflate_buf)
 
     def test_inflate_streamed_chunk(self):
-        with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
-            chunk = raw.read()
-        with gzip.GzipFile(fileobj=io.BytesIO(chunk)) as fh:
-            expected_data = fh.read()
         inflate_buf = memoryview(bytearray(1024 * 1024 * 50))
-        input_buf, data = bytes(), bytes()
-        with open("tests/fixtures/partial.vcf.gz", "rb") as raw:
+        input_buf, data = bytes(), bytearray()
+        with io.BytesIO(self.fixture_bytes) as raw:
             while True:
                 input_buf += raw.read(random.randint(0, 100 * 1024))
                 if not input_buf:
                     break
                 inflate_info = bgzip.inflate_chunks([memoryview(input_buf)], inflate_buf)
-                input_buf = b"".join(inflate_info['remaining_chunks'])
-                data += b"".join(inflate_info['blocks'])
-        self.assertEqual(expected_data, data)
+                input_buf = input_buf[inflate_info['bytes_read']:]
+                data.extend(inflate_info['output'])
+        self.assertEqual(self.expected_data, data)
+
+    def test_inflate_corrupt_block(self):
+        _, blocks = bgzip.Deflater().deflate(memoryview(os.urandom(1024)))
+        inflate_buf = memoryview(bytearray(1024 * 1024))
+
+        with self.subTest("crc mismatch"):
+            block = bytearray(blocks[0])
+            block[-8] ^= 0xff  # CRC is the first field of the block tailer
+            with self.assertRaises(bgzip.bgu.BGZIPException):
+                bgzip.inflate_chunks([memoryview(block)], inflate_buf)
+
+        with self.subTest("malformed header"):
+            block = bytearray(blocks[0])
+            block[0] ^= 0xff
+            with self.assertRaises(bgzip.bgu.BGZIPMalformedHeaderException):
+                bgzip.inflate_chunks([memoryview(block)], inflate_buf)
+
+        with self.subTest("extra field length mismatch"):
+            block = bytearray(blocks[0])
+            block[10] += 1  # XLEN no longer matches the BC subfield
+            with self.assertRaisesRegex(bgzip.bgu.BGZIPMalformedHeaderException, "extra field"):
+                bgzip.inflate_chunks([memoryview(block)], inflate_buf)
+
+        with self.subTest("read all"):
+            block = bytearray(blocks[0])
+            block[-8] ^= 0xff
+            with bgzip.BGZipReader(io.BytesIO(block)) as fh:
+                with self.assertRaises(bgzip.bgu.BGZIPException):
+                    fh.read()
+
+    def test_inflate_extra_subfields(self):
+        expected_data = os.urandom(1024)
+        _, blocks = bgzip.Deflater().deflate(memoryview(expected_data))
+        block = bytes(blocks[0])
+        extra_subfield = b"XY" + struct.pack("<H", 3) + b"abc"
+        header = block[:10] + struct.pack("<H", 6 + len(extra_subfield))
+        bc_subfield = b"BC" + struct.pack("<HH", 2, len(block) + len(extra_subfield) - 1)
+        block = header + extra_subfield + bc_subfield + block[18:]
+        inflate_buf = memoryview(bytearray(1024 * 1024))
+        inflate_info = bgzip.inflate_chunks([memoryview(block)], inflate_buf)
+        self.assertEqual(len(block), inflate_info['bytes_read'])
+        self.assertEqual(expected_data, inflate_buf[:inflate_info['bytes_inflated']])
+
+    def test_inflate_into(self):
+        src = memoryview(self.fixture_bytes)
+        inflate_buf = memoryview(bytearray(1024 * 1024))
+        data = bytearray()
+        while src:
+            bytes_read, bytes_inflated = bgzip.bgu.inflate_into(src, inflate_buf, 4)
+            self.assertGreater(bytes_inflated, 0)
+            data.extend(inflate_buf[:bytes_inflated])
+            src = src[bytes_read:]
+        self.assertEqual(self.expected_data, data)
+
+    def test_zlib_version(self):
+        # zlib-ng compat builds report e.g. "1.3.0.zlib-ng"
+        self.assertRegex(bgzip.bgu.zlib_version, r"^\d+\.\d+")
+
+    def test_buffer_pool(self):
+        pool = bgzip._BufferPool(max_per_size=1)
+        a, b = pool.rent(1024), pool.rent(1024)
+        self.assertIsNot(a, b)
+        pool.return_(a)
+        pool.return_(b)
+        self.assertIs(a, pool.rent(1024))
+        self.assertIsNot(b, pool.rent(1024))
+        self.assertEqual(2048, len(pool.rent(2048)))
+
+    @unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "requires fork")
+    def test_buffer_pool_fork(self):
+        # Buffers rented before forking must not be shared with child processes
+        with bgzip.BGZipReader(io.BytesIO(self.fixture_bytes)) as fh:
+            fh.read(1024)
+        bgzip.BGZipWriter(io.BytesIO()).close()
+        with multiprocessing.get_context("fork").Pool(4) as pool:
+            self.assertEqual([True] * 8, pool.map(_roundtrip_in_child, range(8)))
+
+def _roundtrip_in_child(seed: int) -> bool:
+    size = 4 * 1024 * 1024
+    data = random.Random(seed).getrandbits(size * 8).to_bytes(size, "little")
+    fh = io.BytesIO()
+    with bgzip.BGZipWriter(fh) as writer:
+        writer.write(data)
+    fh.seek(0)
+    with bgzip.BGZipReader(fh, 1024 * 1024) as reader:
+        reinflated_data = bytearray()
+        while True:
+            d = reader.read(1024 * 1024)
+            if not d:
+                break
+            reinflated_data.extend(d)
+    return data == reinflated_data
 
 def _randomly_chunked(items: Sequence[Any]) -> Generator[Sequence[Any], None, None]:
     items = [i for i in items]
@@ -169,24 +426,24 @@ def _randomly_chunked(items: Sequence[Any]) -> Generator[Sequence[Any], None, No
         items = items[chunk_size:]
 
 class TestBGZipWriter(unittest.TestCase):
-    def test_gen_buffers(self):
-        bgzip.Deflater._gen_buffers(bgzip.bgu.block_batch_size)
-        bgzip.Deflater._gen_buffers(1)
+    def test_gen_buffer(self):
+        bgzip.Deflater._gen_buffer(bgzip.bgu.block_batch_size)
+        bgzip.Deflater._gen_buffer(1)
 
-        for num_bufs in [0, bgzip.bgu.block_batch_size + 1]:
+        for num_blocks in [0, bgzip.bgu.block_batch_size + 1]:
             with self.assertRaises(ValueError):
-                bgzip.Deflater._gen_buffers(num_bufs)
+                bgzip.Deflater._gen_buffer(num_blocks)
 
     def test_write(self):
         inflated_data = os.urandom(1024 * 1024 * 50)
         deflater = bgzip.Deflater()
-        deflated_with_buffers = bytes()
+        deflated_with_buffers = bytearray()
         data = memoryview(bytes(inflated_data))
         while data:
-            bytes_deflated, deflated_blocks = deflater.deflate(data)
+            bytes_deflated, deflated, _ = deflater.deflate_contiguous(data)
             data = data[bytes_deflated:]
-            deflated_with_buffers += b"".join(deflated_blocks)
-        deflated_with_buffers += bgzip.bgzip_eof
+            deflated_with_buffers.extend(deflated)
+        deflated_with_buffers.extend(bgzip.bgzip_eof)
 
         fh_out = io.BytesIO()
         with bgzip.BGZipWriter(fh_out) as writer:
@@ -204,11 +461,33 @@ class TestBGZipWriter(unittest.TestCase):
         self.assertEqual(inflated_data, reinflated_data)
         self.assertTrue(deflated_with_writer.endswith(bgzip.bgzip_eof))
 
+    def test_large_aligned_write(self):
+        inflated_data = os.urandom((bgzip.bgu.block_batch_size + 1) * bgzip.bgu.block_data_inflated_size + 123)
+        fh_buffered, fh_topped_up, fh_direct = io.BytesIO(), io.BytesIO(), io.BytesIO()
+        with bgzip.BGZipWriter(fh_buffered) as writer:
+            for i in range(0, len(inflated_data), 10000):
+                writer.write(inflated_data[i:i + 10000])
+        with bgzip.BGZipWriter(fh_topped_up) as writer:
+            writer.write(inflated_data[:1])
+            writer.write(inflated_data[1:])
+        with bgzip.BGZipWriter(fh_direct) as writer:
+            writer.write(inflated_data)
+        self.assertEqual(fh_buffered.getvalue(), fh_topped_up.getvalue())
+        self.assertEqual(fh_buffered.getvalue(), fh_direct.getvalue())
+
     def test_write_random_data(self):
         inflated_data = os.urandom(1024 * 1024)
         with bgzip.BGZipWriter(io.BytesIO()) as writer:
             writer.write(inflated_data)
 
+    def test_write_after_close(self):
+        for size in [1, (bgzip.bgu.block_batch_size + 1) * bgzip.bgu.block_data_inflated_size]:
+            with self.subTest(size=size):
+                writer = bgzip.BGZipWriter(io.BytesIO())
+                writer.close()
+                with self.assertRaises(ValueError):
+                    writer.write(bytes(size))
+
     def test_pathalogical_write(self):
         fh = io.BytesIO()
         with bgzip.BGZipWriter(fh):
@@ -220,7 +499,7 @@ class TestBGZipWriter(unittest.TestCase):
         with bgzip.BGZipWriter(fh_out) as writer:
             number_of_blocks = 2 * bgzip.bgu.block_batch_size + 1
             size = number_of_blocks * bgzip.bgu.block_data_inflated_size
-            writer.write(bytearray(size))
+            writer.write(bytes(size))
 
 if __name__ == '__main__':
     unittest.main()